@@ -3,7 +3,7 @@
 @file medgemma-local.py
 @description Local MedGemma inference service using Hugging Face transformers
 @module api
-@requires transformers torch accelerate bitsandbytes
+@requires transformers torch accelerate bitsandbytes fastapi uvicorn orjson
 
 Key responsibilities:
 - Local MedGemma model inference with quantization
@@ -17,18 +17,32 @@ Key responsibilities:
 """
 
 import os
-import json
+import array
+import asyncio
+import queue
+import threading
+import uuid
+import orjson
 import torch
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple, Callable
 from dataclasses import dataclass
 from transformers import (
     AutoTokenizer, 
     AutoModelForCausalLM, 
     BitsAndBytesConfig,
+    DynamicCache,
+    StaticCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
     pipeline
 )
+from transformers.utils import is_flash_attn_2_available
 from huggingface_hub import login
-from flask import Flask, request, jsonify
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import uvicorn
 import time
 import logging
 
@@ -36,14 +50,216 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Instructions prepended to the user turn for each analysis type
+TASK_PREFIXES = {
+    "clinical_qa": "Answer this clinical question based on medical knowledge:",
+    "text_analysis": "Analyze the following clinical text and provide insights:",
+    "search_enhancement": "Convert this query to medical terminology:",
+    "image_analysis": "Analyze this radiology finding:"
+}
+DEFAULT_TASK_PREFIX = "Provide medical assistance for:"
+
+# Gemma turn format, used when a checkpoint ships without a chat template
+GEMMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}{{ raise_exception('System role not supported') }}{% endif %}"
+    "<start_of_turn>{{ 'model' if message['role'] == 'assistant' else message['role'] }}\n"
+    "{{ message['content'] }}<end_of_turn>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<start_of_turn>model\n{% endif %}"
+)
+
+# Stand-in user text used to locate where a rendered chat template diverges
+_USER_PLACEHOLDER = "\x00MEDGEMMA_USER\x00"
+
+ChatMessages = List[Dict[str, str]]
+LegacyKV = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
 @dataclass
 class MedGemmaConfig:
     """Configuration for MedGemma models"""
     model_id: str = "RSM-VLM/med-gemma"
+    backend: str = "transformers"
+    vllm_quantization: Optional[str] = "awq"
     use_quantization: bool = True
     device_map: str = "auto"
     max_memory: Optional[Dict[str, str]] = None
+    offload_folder: str = "/tmp/medgemma_offload"
+    attn_implementation: Optional[str] = None
     torch_dtype: torch.dtype = torch.bfloat16
+    max_batch_size: int = 8
+    batch_timeout_ms: float = 10.0
+    max_input_length: int = 2048
+    max_new_tokens: int = 512
+    use_static_cache: bool = True
+    # Extra smaller batch-bucket caches are allocated lazily within this budget;
+    # None keeps only the max_batch_size cache
+    kv_cache_max_mb: Optional[int] = None
+    use_torch_compile: bool = True
+    input_length_buckets: Tuple[int, ...] = (128, 512, 2048)
+    use_prefix_cache: bool = True
+    
+    @property
+    def max_cache_len(self) -> int:
+        """KV-cache length needed for the longest prompt plus generation"""
+        return self.max_input_length + self.max_new_tokens
+
+@dataclass
+class MedicalPrompt:
+    """User input for one analysis request, before templating"""
+    text: str
+    task_type: str = "general"
+    context: str = ""
+
+class CancelGeneration(StoppingCriteria):
+    """Stops a running generate() once set, e.g. after a streaming client disconnects"""
+    
+    def __init__(self):
+        self._event = threading.Event()
+    
+    def set(self):
+        self._event.set()
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self._event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+@dataclass
+class GenerationRequest:
+    """Single tokenized prompt waiting in the batch queue"""
+    input_ids: List[int]
+    params: Dict[str, Any]
+    future: asyncio.Future
+    streamer: Optional[TextIteratorStreamer] = None
+    cancel: Optional[CancelGeneration] = None
+
+    @property
+    def batch_key(self) -> Tuple:
+        """Requests can only share a generate() call if sampling params match"""
+        key = tuple(sorted(self.params.items()))
+        # Streamers only support a single sequence, so streamed requests run alone
+        return key if self.streamer is None else key + (id(self),)
+
+class RequestQueue:
+    """
+    Coalesces concurrent prompts into batched generate() calls
+    
+    A background thread owns an asyncio loop running `_batch_worker`, which
+    drains up to `max_batch_size` pending requests (or waits `timeout_ms`)
+    and hands them to `run_batch` on a dedicated GPU thread. Prompts are
+    tokenized on `encode_executor` before they are queued, so that CPU work
+    overlaps with the batch currently on the GPU. Callers await a
+    per-request future from the server's own event loop.
+    """
+    
+    def __init__(
+        self,
+        run_batch: Callable[
+            [List[List[int]], Dict[str, Any], Optional[TextIteratorStreamer], Optional[CancelGeneration]],
+            List[Dict[str, Any]]
+        ],
+        encode: Callable[[MedicalPrompt], List[int]],
+        encode_executor: ThreadPoolExecutor,
+        max_batch_size: int = 8,
+        timeout_ms: float = 10.0
+    ):
+        self.run_batch = run_batch
+        self.encode = encode
+        self._encode_executor = encode_executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.timeout = timeout_ms / 1000.0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._loop = asyncio.new_event_loop()
+        self._gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="medgemma-gpu")
+        self._thread = threading.Thread(target=self._run_loop, name="medgemma-batcher", daemon=True)
+        self._thread.start()
+    
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.create_task(self._batch_worker())
+        self._loop.run_forever()
+    
+    async def _enqueue(
+        self,
+        prompt: MedicalPrompt,
+        params: Dict[str, Any],
+        streamer: Optional[TextIteratorStreamer],
+        cancel: Optional[CancelGeneration]
+    ) -> Dict[str, Any]:
+        input_ids = await self._loop.run_in_executor(self._encode_executor, self.encode, prompt)
+        future = self._loop.create_future()
+        await self._queue.put(GenerationRequest(
+            input_ids=input_ids, params=params, future=future, streamer=streamer, cancel=cancel
+        ))
+        return await future
+    
+    async def submit(
+        self,
+        prompt: MedicalPrompt,
+        params: Dict[str, Any],
+        streamer: Optional[TextIteratorStreamer] = None,
+        cancel: Optional[CancelGeneration] = None
+    ) -> Dict[str, Any]:
+        """
+        Queue a prompt and wait until its batch has been generated
+        
+        Cancelling the awaiting task drops the request if its batch has not
+        started yet; set `cancel` to stop one that is already generating.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(prompt, params, streamer, cancel), self._loop)
+        return await asyncio.wrap_future(future)
+    
+    def run_on_gpu_thread(self, batch_ids: List[List[int]], params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Run a batch synchronously on the GPU thread, bypassing the queue"""
+        return self._gpu_executor.submit(self.run_batch, batch_ids, params, None, None).result()
+    
+    async def _collect_batch(self) -> List[GenerationRequest]:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.timeout
+        
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    async def _batch_worker(self):
+        while True:
+            batch = await self._collect_batch()
+            
+            groups: Dict[Tuple, List[GenerationRequest]] = {}
+            for item in batch:
+                groups.setdefault(item.batch_key, []).append(item)
+            
+            for group in groups.values():
+                # Skip requests whose caller went away while they were queued
+                group = [item for item in group if not item.future.done()]
+                if not group:
+                    continue
+                
+                try:
+                    results = await self._loop.run_in_executor(
+                        self._gpu_executor,
+                        self.run_batch,
+                        [item.input_ids for item in group],
+                        group[0].params,
+                        group[0].streamer,
+                        group[0].cancel
+                    )
+                except Exception as e:
+                    for item in group:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                
+                for item, result in zip(group, results):
+                    if not item.future.done():
+                        item.future.set_result(result)
 
 class MedGemmaInference:
     """
@@ -56,7 +272,32 @@ class MedGemmaInference:
         self.model = None
         self.tokenizer = None
         self.pipeline = None
+        self.engine = None
+        self._sampling_params_cls = None
+        self.kv_caches: Dict[int, StaticCache] = {}
+        self._kv_cache_bytes = 0
+        self._batch_buckets = self._build_batch_buckets(config.max_batch_size)
+        self._length_buckets = sorted(
+            {b for b in config.input_length_buckets if b < config.max_input_length} | {config.max_input_length}
+        )
+        self._compiled = False
+        self._supports_system_role = True
+        self._prefix_ids: Dict[str, List[int]] = {}
+        self._default_prefix_ids: List[int] = []
+        self._separator_ids: List[int] = []
+        self._suffix_ids: List[int] = []
+        # Prefilled KV state of each task's prompt head, keyed by its token ids
+        self._prefix_cache: Dict[bytes, Tuple[List[int], LegacyKV]] = {}
         self._load_model()
+        self._tok_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="medgemma-tokenizer")
+        # Serving engines schedule requests themselves, so only transformers goes through the window batcher
+        self._request_queue = None if self.engine is not None else RequestQueue(
+            self._generate_batch,
+            encode=self.encode_prompt,
+            encode_executor=self._tok_pool,
+            max_batch_size=config.max_batch_size,
+            timeout_ms=config.batch_timeout_ms
+        )
     
     def _setup_quantization(self) -> Optional[BitsAndBytesConfig]:
         """Setup 4-bit quantization for memory efficiency"""
@@ -67,9 +308,25 @@ class MedGemmaInference:
             load_in_4bit=True,
             bnb_4bit_compute_dtype=self.config.torch_dtype,
             bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4"
+            bnb_4bit_quant_type="nf4",
+            # Store packed weights in the compute dtype instead of uint8
+            bnb_4bit_quant_storage=self.config.torch_dtype
         )
     
+    def _select_attn_implementation(self) -> str:
+        """Pick FlashAttention-2 when usable, otherwise PyTorch SDPA"""
+        if self.config.attn_implementation:
+            return self.config.attn_implementation
+        
+        # FA2 needs fp16/bf16 and does not support StaticCache, so SDPA is used alongside it
+        if (
+            is_flash_attn_2_available()
+            and not self.config.use_static_cache
+            and self.config.torch_dtype in (torch.float16, torch.bfloat16)
+        ):
+            return "flash_attention_2"
+        return "sdpa"
+    
     def _load_model(self):
         """Load MedGemma model and tokenizer"""
         try:
@@ -93,109 +350,736 @@ class MedGemmaInference:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
+            # Decoder-only batches must be left-padded so generation continues from the prompt
+            self.tokenizer.padding_side = "left"
+            
+            if not getattr(self.tokenizer, "chat_template", None):
+                self.tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+            
+            self._supports_system_role = self._detect_system_role()
+            self._build_prompt_templates()
+            
+            if self.config.backend == "tensorrt_llm":
+                self._load_trtllm_engine()
+                return
+            
+            if self.config.backend == "vllm":
+                self._load_vllm_engine()
+                return
+            
+            attn_implementation = self._select_attn_implementation()
+            
             # Load model with optimizations
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.config.model_id,
-                quantization_config=quantization_config,
-                device_map=self.config.device_map,
-                torch_dtype=self.config.torch_dtype,
-                trust_remote_code=True,
-                max_memory=self.config.max_memory
-            )
+            try:
+                self.model = self._load_causal_lm(quantization_config, attn_implementation)
+            except ImportError as e:
+                if attn_implementation != "flash_attention_2":
+                    raise
+                logger.warning(f"FlashAttention-2 unavailable ({e}), falling back to SDPA")
+                attn_implementation = "sdpa"
+                self.model = self._load_causal_lm(quantization_config, attn_implementation)
+            
+            self.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
             
-            logger.info(f"Model loaded successfully on device: {self.model.device}")
+            logger.info(f"Model loaded successfully on device: {self.model.device} (attention: {attn_implementation})")
+            
+            if self.config.use_static_cache:
+                self._allocate_kv_caches()
+            
+            if self.config.use_prefix_cache:
+                self._prime_prefix_cache()
+            
+            if self.config.use_torch_compile:
+                self._compile_model()
             
         except Exception as e:
             logger.error(f"Failed to load MedGemma model: {e}")
             raise
     
-    def format_medical_prompt(self, text: str, task_type: str = "general") -> str:
+    def _load_trtllm_engine(self):
+        """
+        Load an NVFP4 checkpoint into a TensorRT-LLM engine
+        @reftools Following TensorRT-LLM LLM API with ModelOpt NVFP4 checkpoints
+        
+        model_id must point at a checkpoint pre-quantized with ModelOpt, e.g.
+        `python -m modelopt.torch.quantization.quantize --format nvfp4`. The
+        engine runs FP4 GEMMs natively on Blackwell tensor cores and manages
+        its own KV cache and attention kernels. Requests go to it one by one
+        through generate_async, so its in-flight batching does the scheduling.
+        """
+        try:
+            from tensorrt_llm import LLM, SamplingParams
+            from tensorrt_llm.llmapi import QuantConfig, QuantAlgo
+        except ImportError as e:
+            raise RuntimeError("backend 'tensorrt_llm' requires tensorrt_llm: pip install tensorrt_llm") from e
+        
+        self.engine = LLM(
+            model=self.config.model_id,
+            quant_config=QuantConfig(quant_algo=QuantAlgo.NVFP4),
+            max_batch_size=self.config.max_batch_size,
+            max_seq_len=self.config.max_cache_len
+        )
+        self._sampling_params_cls = SamplingParams
+        
+        logger.info(f"TensorRT-LLM engine loaded with NVFP4 weights: {self.config.model_id}")
+    
+    def _load_vllm_engine(self):
+        """
+        Load an AWQ/GPTQ INT4 checkpoint into vLLM
+        @reftools Following vLLM AsyncLLMEngine API
+        
+        model_id must point at a pre-quantized checkpoint matching
+        vllm_quantization. vLLM runs packed INT4 GEMMs instead of the
+        dequantize-then-bf16 matmul used by bitsandbytes NF4. The async engine
+        takes requests one by one and continuously batches them itself.
+        """
+        try:
+            from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+        except ImportError as e:
+            raise RuntimeError("backend 'vllm' requires vllm: pip install vllm") from e
+        
+        self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+            model=self.config.model_id,
+            quantization=self.config.vllm_quantization,
+            dtype=str(self.config.torch_dtype).replace("torch.", ""),
+            gpu_memory_utilization=0.9,
+            max_model_len=self.config.max_cache_len,
+            max_num_seqs=self.config.max_batch_size,
+            trust_remote_code=True
+        ))
+        self._sampling_params_cls = SamplingParams
+        
+        logger.info(f"vLLM engine loaded ({self.config.vllm_quantization}): {self.config.model_id}")
+    
+    def _load_causal_lm(self, quantization_config: Optional[BitsAndBytesConfig], attn_implementation: str):
+        # Unquantized weights may not fit the GPU; let accelerate spill to disk instead of OOMing
+        offload_kwargs = {} if quantization_config else {
+            "offload_folder": self.config.offload_folder,
+            "offload_state_dict": True
+        }
+        
+        return AutoModelForCausalLM.from_pretrained(
+            self.config.model_id,
+            quantization_config=quantization_config,
+            device_map=self.config.device_map,
+            torch_dtype=self.config.torch_dtype,
+            attn_implementation=attn_implementation,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+            max_memory=self.config.max_memory,
+            **offload_kwargs
+        )
+    
+    @staticmethod
+    def _build_batch_buckets(max_batch_size: int) -> List[int]:
+        """Powers of two up to max_batch_size, so only a few cache shapes exist"""
+        buckets = []
+        size = 1
+        while size < max_batch_size:
+            buckets.append(size)
+            size *= 2
+        buckets.append(max(1, max_batch_size))
+        return buckets
+    
+    def _kv_cache_size(self, batch_size: int) -> int:
+        """Bytes of key and value buffers in a StaticCache for batch_size rows"""
+        config = self.model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        element_size = torch.finfo(self.config.torch_dtype).bits // 8
+        return 2 * config.num_hidden_layers * batch_size * kv_heads * self.config.max_cache_len * head_dim * element_size
+    
+    def _new_kv_cache(self, batch_size: int):
+        self.kv_caches[batch_size] = StaticCache(
+            config=self.model.config,
+            max_batch_size=batch_size,
+            max_cache_len=self.config.max_cache_len,
+            device=self.model.device,
+            dtype=self.config.torch_dtype
+        )
+        self._kv_cache_bytes += self._kv_cache_size(batch_size)
+        
+        logger.info(
+            f"Allocated static KV cache for batch size {batch_size} "
+            f"(max_cache_len={self.config.max_cache_len}, {self._kv_cache_bytes / 2**30:.2f} GiB in total)"
+        )
+    
+    def _allocate_kv_caches(self):
+        """
+        Pre-allocate the StaticCache for max_batch_size
+        @reftools Following HF transformers StaticCache generation pattern
+        
+        Every batch fits this one cache. Smaller buckets only get their own
+        cache on first use, and only within kv_cache_max_mb.
+        """
+        if not getattr(self.model, "_supports_static_cache", False):
+            logger.warning("Model does not support StaticCache, using dynamic KV cache")
+            return
+        
+        self._new_kv_cache(self._batch_buckets[-1])
+    
+    def _kv_cache_for(self, batch_size: int) -> Tuple[int, StaticCache]:
+        """Smallest bucket cache that fits the batch, allocating it if the budget allows"""
+        if self.config.kv_cache_max_mb is None:
+            budget = self._kv_cache_size(self._batch_buckets[-1])
+        else:
+            budget = self.config.kv_cache_max_mb * 2**20
+        
+        for bucket in self._batch_buckets:
+            if bucket < batch_size:
+                continue
+            if bucket not in self.kv_caches and self._kv_cache_bytes + self._kv_cache_size(bucket) <= budget:
+                self._new_kv_cache(bucket)
+            if bucket in self.kv_caches:
+                return bucket, self.kv_caches[bucket]
+    
+    @staticmethod
+    def _prefix_key(ids: List[int]) -> bytes:
+        return array.array("l", ids).tobytes()
+    
+    def _prime_prefix_cache(self):
+        """
+        Prefill the prompt head of every task type once at startup
+        
+        The heads are the pre-tokenized per-task prefix ids, so this is a
+        fixed table with one entry per task type; nothing is added while serving.
+        """
+        for ids in [*self._prefix_ids.values(), self._default_prefix_ids]:
+            key = self._prefix_key(ids)
+            if key not in self._prefix_cache:
+                self._prefix_cache[key] = (ids, self._prefill_prefix(ids))
+        
+        size = sum(
+            k.numel() * k.element_size() + v.numel() * v.element_size()
+            for _, past in self._prefix_cache.values()
+            for k, v in past
+        )
+        logger.info(
+            f"Prefix KV cache primed with {len(self._prefix_cache)} prompt heads "
+            f"({size / 2**20:.1f} MB)"
+        )
+    
+    def _prefill_prefix(self, ids: List[int]) -> LegacyKV:
+        with torch.no_grad():
+            past = self.model(
+                input_ids=torch.tensor([ids], device=self.model.device),
+                use_cache=True
+            ).past_key_values
+        
+        if hasattr(past, "to_legacy_cache"):
+            past = past.to_legacy_cache()
+        return past
+    
+    def _lookup_prefix(self, batch_ids: List[List[int]]) -> Optional[Tuple[List[int], LegacyKV]]:
+        """Return the longest cached head shared by every row, leaving at least one token to prefill"""
+        entries = sorted(self._prefix_cache.values(), key=lambda entry: len(entry[0]), reverse=True)
+        
+        for prefix_ids, past in entries:
+            length = len(prefix_ids)
+            if all(len(ids) > length and ids[:length] == prefix_ids for ids in batch_ids):
+                return prefix_ids, past
+        
+        return None
+    
+    def _apply_prefix(self, inputs, entry: Tuple[List[int], LegacyKV], kv_cache: Optional[StaticCache]):
+        """
+        Seed the KV cache with a cached head so generate() only prefills the rest
+        
+        `inputs` holds the padded remainder of each row. The head is put in
+        front of it, so it sits at cache positions 0..n-1 for every row and the
+        padding lands between the head and the rest. The attention mask still
+        hides the padding, and position ids are derived from that mask.
+        """
+        prefix_ids, past = entry
+        batch_size = inputs["input_ids"].shape[0]
+        
+        head = torch.tensor([prefix_ids] * batch_size, dtype=inputs["input_ids"].dtype)
+        inputs["input_ids"] = torch.cat([head, inputs["input_ids"]], dim=1)
+        inputs["attention_mask"] = torch.cat([torch.ones_like(head), inputs["attention_mask"]], dim=1)
+        
+        # The head was prefilled once; share it across the batch without copying
+        past = tuple(
+            (key_states.expand(batch_size, -1, -1, -1), value_states.expand(batch_size, -1, -1, -1))
+            for key_states, value_states in past
+        )
+        
+        if kv_cache is None:
+            return DynamicCache.from_legacy_cache(past)
+        
+        cache_position = torch.arange(len(prefix_ids), device=self.model.device)
+        for layer_idx, (key_states, value_states) in enumerate(past):
+            kv_cache.update(key_states, value_states, layer_idx, {"cache_position": cache_position})
+        return kv_cache
+    
+    def _compile_model(self):
+        """
+        Compile the forward pass so decode steps replay as CUDA graphs
+        @reftools Following HF transformers torch.compile + StaticCache guidance
+        """
+        if torch.__version__ < "2.2":
+            logger.warning(f"torch.compile requires torch>=2.2, found {torch.__version__}")
+            return
+        
+        if not self.kv_caches:
+            # Without fixed cache shapes every decode step would recompile
+            logger.warning("torch.compile skipped: requires static KV caches")
+            return
+        
+        # One graph per prefill (length bucket x batch bucket) and per decode batch bucket.
+        # Prefix-cache prefills reuse the same shapes. Past the limit dynamo silently runs eager.
+        num_shapes = len(self._length_buckets) * len(self._batch_buckets) + len(self._batch_buckets)
+        dynamo_config = torch._dynamo.config
+        limit_name = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+        setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), num_shapes))
+        
+        # generate() calls self.forward, so compile that rather than wrapping the module
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        self._compiled = True
+        logger.info(
+            f"Compiled model forward for input length buckets {self._length_buckets} "
+            f"and batch buckets {self._batch_buckets} ({limit_name}={getattr(dynamo_config, limit_name)})"
+        )
+    
+    def _length_bucket(self, length: int) -> int:
+        return next((b for b in self._length_buckets if b >= length), self._length_buckets[-1])
+    
+    def _detect_system_role(self) -> bool:
+        """Older Gemma chat templates reject system messages outright"""
+        try:
+            self.tokenizer.apply_chat_template(
+                [{"role": "system", "content": "x"}, {"role": "user", "content": "x"}],
+                tokenize=False
+            )
+            return True
+        except Exception:
+            return False
+    
+    def _build_prompt_templates(self):
         """
-        Format prompt for MedGemma with proper chat template
-        @reftools Following RSM-VLM/med-gemma prompt formatting
+        Pre-tokenize the fixed parts of every task's chat prompt
+        
+        The chat template is rendered once per task around a placeholder user
+        message. The text before the placeholder becomes that task's prefix ids
+        and the text after it the shared suffix ids. Requests then only tokenize
+        their own text, and each task's prompt head always has the same ids,
+        which is what the prefix KV cache matches on.
         """
-        task_prefixes = {
-            "clinical_qa": "Answer this clinical question based on medical knowledge:",
-            "text_analysis": "Analyze the following clinical text and provide insights:",
-            "search_enhancement": "Convert this query to medical terminology:",
-            "image_analysis": "Analyze this radiology finding:"
+        def render(prefix: str) -> Tuple[List[int], List[int]]:
+            messages = self.build_messages(_USER_PLACEHOLDER, prefix=prefix)
+            rendered = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            head, tail = rendered.split(_USER_PLACEHOLDER, 1)
+            return self._encode_text(head), self._encode_text(tail)
+        
+        self._prefix_ids = {task_type: render(prefix)[0] for task_type, prefix in TASK_PREFIXES.items()}
+        self._default_prefix_ids, self._suffix_ids = render(DEFAULT_TASK_PREFIX)
+        self._separator_ids = self._encode_text("\n\n")
+    
+    def _encode_text(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+    
+    def build_messages(
+        self,
+        text: str,
+        task_type: str = "general",
+        prefix: Optional[str] = None
+    ) -> ChatMessages:
+        """
+        Build chat messages for MedGemma, with the task prefix as the system turn
+        @reftools Following HF tokenizer chat template API
+        
+        Request context belongs in `text`, ahead of the input, so the system
+        turn only depends on the task type and can be pre-tokenized.
+        """
+        if prefix is None:
+            prefix = TASK_PREFIXES.get(task_type, DEFAULT_TASK_PREFIX)
+        
+        if not self._supports_system_role:
+            return [{"role": "user", "content": f"{prefix}\n\n{text}"}]
+        
+        return [
+            {"role": "system", "content": prefix},
+            {"role": "user", "content": text}
+        ]
+    
+    @property
+    def supports_streaming(self) -> bool:
+        """Token streaming is only available on the transformers backend"""
+        return self.engine is None
+    
+    def create_streamer(self, timeout: Optional[float] = None) -> TextIteratorStreamer:
+        return TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+    
+    def warmup(self, max_new_tokens: int = 16):
+        """
+        Run dummy generations for every padded shape before serving traffic
+        
+        Moves cuDNN autotuning, kernel JIT and torch.compile graph capture out
+        of the first user requests. Covers each input length bucket, each batch
+        bucket, and the prefix-cache path for each task type. Runs on the
+        queue's GPU thread, since CUDA graphs captured under reduce-overhead
+        are kept per thread and only replay on the thread that captured them.
+        """
+        if self.engine is not None:
+            return
+        
+        start_time = time.time()
+        pad_id = self.tokenizer.eos_token_id
+        params = {
+            "max_new_tokens": max_new_tokens,
+            "temperature": 0.7,
+            "top_k": 50,
+            "top_p": 0.95,
+            "do_sample": True
         }
         
-        prefix = task_prefixes.get(task_type, "Provide medical assistance for:")
+        run = self._request_queue.run_on_gpu_thread
+        
+        for length in self._length_buckets:
+            run([[pad_id] * length], params)
+        
+        for batch_size in self._batch_buckets[1:]:
+            run([[pad_id] * self._length_buckets[0]] * batch_size, params)
+        
+        for prefix_ids, _ in self._prefix_cache.values():
+            run([prefix_ids + [pad_id] * 8], params)
+        
+        logger.info(f"Warmup completed in {time.time() - start_time:.2f}s")
+        
+        if self._compiled:
+            self._log_compiled_graphs()
+    
+    def _log_compiled_graphs(self):
+        """Report how many graphs dynamo captured, to catch silent fallbacks to eager"""
+        from torch._dynamo.utils import counters
+        
+        dynamo_config = torch._dynamo.config
+        limit = getattr(dynamo_config, "recompile_limit", None) or dynamo_config.cache_size_limit
+        graphs = counters["stats"]["unique_graphs"]
+        # Dynamo records the limit being hit as an unimplemented-feature counter
+        limit_hits = sum(
+            count for reason, count in counters["unimplemented"].items()
+            if "cache_size_limit" in reason or "recompile_limit" in reason
+        )
+        
+        logger.info(f"torch.compile captured {graphs} graphs after warmup (recompile limit {limit})")
+        if limit_hits:
+            logger.warning(f"Recompile limit hit {limit_hits} times; those shapes run eagerly")
+    
+    def encode_prompt(self, prompt: MedicalPrompt) -> List[int]:
+        """
+        Tokenize a request by joining pre-tokenized template parts with its text
         
-        # Use Gemma's chat template format
-        prompt = f"<start_of_turn>user\n{prefix}\n\n{text}<end_of_turn>\n<start_of_turn>model\n"
-        return prompt
+        The layout is that of build_messages(f"{context}\n\n{text}"): the
+        context opens the user turn. Each piece is tokenized on its own, so
+        ids at the joins can differ from tokenizing the rendered template in
+        one go. Only the user turn is truncated to fit max_input_length, so
+        the prompt head and the generation prompt are always kept.
+        """
+        prefix_ids = self._prefix_ids.get(prompt.task_type, self._default_prefix_ids)
+        
+        body_ids = self._encode_text(prompt.text)
+        if prompt.context:
+            body_ids = self._encode_text(prompt.context) + self._separator_ids + body_ids
+        
+        budget = max(0, self.config.max_input_length - len(prefix_ids) - len(self._suffix_ids))
+        return prefix_ids + body_ids[:budget] + self._suffix_ids
     
-    def generate_response(
+    async def generate_response(
         self,
-        prompt: str,
+        prompt: MedicalPrompt,
         max_new_tokens: int = 512,
         temperature: float = 0.7,
         top_k: int = 50,
         top_p: float = 0.95,
-        do_sample: bool = True
+        do_sample: bool = True,
+        return_tokens: bool = False,
+        return_offsets: bool = False,
+        streamer: Optional[TextIteratorStreamer] = None,
+        cancel: Optional[CancelGeneration] = None
     ) -> Dict[str, Any]:
-        """Generate response from MedGemma model"""
-        if not self.model or not self.tokenizer:
+        """
+        Generate response from MedGemma model, batched with concurrent requests
+        
+        If a streamer is given, decoded text is pushed to it as tokens are
+        generated and the request runs as its own batch; setting `cancel`
+        stops it early. With return_tokens
+        the generated token ids are returned and decoding is skipped; with
+        return_offsets the text is returned with per-token character spans.
+        """
+        if not (self.model or self.engine) or not self.tokenizer:
             raise RuntimeError("Model not loaded")
         
         start_time = time.time()
         
+        params = {
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p,
+            "do_sample": do_sample,
+            "return_tokens": return_tokens,
+            "return_offsets": return_offsets
+        }
+        
         try:
-            # Tokenize input
-            inputs = self.tokenizer(
-                prompt, 
-                return_tensors="pt",
-                truncation=True,
-                max_length=2048
-            ).to(self.model.device)
+            if self.engine is not None:
+                input_ids = await asyncio.get_running_loop().run_in_executor(self._tok_pool, self.encode_prompt, prompt)
+                output = await self._generate_engine(input_ids, params)
+            else:
+                output = await self._request_queue.submit(prompt, params, streamer=streamer, cancel=cancel)
             
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    temperature=temperature,
-                    top_k=top_k,
-                    top_p=top_p,
-                    do_sample=do_sample,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    repetition_penalty=1.1
+            if return_offsets:
+                # Build the spans on the tokenizer pool so the GPU thread can move on
+                token_ids = output["token_ids"] if return_tokens else output.pop("token_ids")
+                output["result"], output["text_offsets"] = await asyncio.get_running_loop().run_in_executor(
+                    self._tok_pool, self._decode_with_offsets, token_ids
                 )
             
-            # Decode response
-            full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            # Extract only the generated part (remove input prompt)
-            generated_text = full_response[len(self.tokenizer.decode(inputs['input_ids'][0], skip_special_tokens=True)):].strip()
-            
             processing_time = time.time() - start_time
             
-            return {
-                "success": True,
-                "result": generated_text,
+            response = {"success": True}
+            response.update({key: output[key] for key in ("result", "token_ids", "text_offsets") if key in output})
+            response.update({
                 "model": self.config.model_id,
                 "processing_time": processing_time,
-                "tokens_generated": len(outputs[0]) - len(inputs['input_ids'][0])
-            }
+                "tokens_generated": output["tokens_generated"]
+            })
+            return response
             
         except Exception as e:
             logger.error(f"Generation failed: {e}")
+            if streamer is not None:
+                # Unblock the consumer; generate() never reached its own end()
+                streamer.end()
             return {
                 "success": False,
                 "error": str(e),
                 "model": self.config.model_id,
                 "processing_time": time.time() - start_time
             }
+    
+    def _generate_batch(
+        self,
+        batch_ids: List[List[int]],
+        params: Dict[str, Any],
+        streamer: Optional[TextIteratorStreamer] = None,
+        cancel: Optional[CancelGeneration] = None
+    ) -> List[Dict[str, Any]]:
+        """Run one padded generate() call for prompts sharing sampling params"""
+        num_prompts = len(batch_ids)
+        kv_cache = None
+        
+        if self.kv_caches:
+            # Static caches have a fixed batch dimension; fill the bucket with
+            # copies of the last prompt and drop their outputs afterwards
+            bucket, kv_cache = self._kv_cache_for(num_prompts)
+            batch_ids = batch_ids + [batch_ids[-1]] * (bucket - num_prompts)
+        
+        inputs = None
+        
+        # Reuse a cached head when every row starts with it, i.e. all rows share a task type
+        entry = self._lookup_prefix(batch_ids) if self._prefix_cache else None
+        if entry is not None:
+            # Only the rest is padded to a bucket, so the prefill has the same shape as without a head
+            inputs = self._pad_inputs([ids[len(entry[0]):] for ids in batch_ids])
+            if len(entry[0]) + inputs["input_ids"].shape[1] <= self.config.max_input_length:
+                kv_cache = self._apply_prefix(inputs, entry, kv_cache)
+            else:
+                # Head plus a whole bucket would overrun the KV cache
+                inputs = None
+        
+        if inputs is None:
+            inputs = self._pad_inputs(batch_ids)
+        
+        if self.model.device.type == "cuda":
+            # Copy from pinned host memory so the H2D transfer runs asynchronously
+            inputs = {
+                name: tensor.pin_memory().to(self.model.device, non_blocking=True)
+                for name, tensor in inputs.items()
+            }
+        else:
+            inputs = inputs.to(self.model.device)
+        
+        # Generate responses
+        try:
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    input_ids=inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    past_key_values=kv_cache,
+                    max_new_tokens=min(params["max_new_tokens"], self.config.max_new_tokens),
+                    temperature=params["temperature"],
+                    top_k=params["top_k"],
+                    top_p=params["top_p"],
+                    do_sample=params["do_sample"],
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    repetition_penalty=1.1,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([cancel]) if cancel is not None else None
+                )
+        finally:
+            if isinstance(kv_cache, StaticCache):
+                kv_cache.reset()
+        
+        # Slice off the prompt at the token level
+        prompt_len = inputs["input_ids"].shape[1]
+        gen_ids = outputs[:num_prompts, prompt_len:]
+        
+        # Rows that finished early are padded out to the longest one in the batch
+        tokens_generated = (gen_ids != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        
+        token_lists = [row[:count].tolist() for row, count in zip(gen_ids, tokens_generated)]
+        return self._format_outputs(token_lists, params)
+    
+    def _pad_inputs(self, batch_ids: List[List[int]]):
+        """Left-pad tokenized prompts to a shared length"""
+        if self._compiled:
+            # Pad to a fixed bucket so the compiled graphs are reused instead of recompiled
+            longest = max(len(ids) for ids in batch_ids)
+            padding = {"padding": "max_length", "max_length": self._length_bucket(longest)}
+        else:
+            padding = {"padding": True}
+        
+        return self.tokenizer.pad({"input_ids": batch_ids}, return_tensors="pt", **padding)
+    
+    def _format_outputs(
+        self,
+        token_lists: List[List[int]],
+        params: Dict[str, Any],
+        texts: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Shape per-request outputs according to the return_tokens / return_offsets options
+        
+        Shared by every backend. Plain requests get decoded text, using the
+        engine's own `texts` when given. return_tokens and return_offsets get
+        raw token ids and skip decoding here; offsets are built by
+        generate_response once the batch is done, off the GPU thread.
+        """
+        if params.get("return_tokens") or params.get("return_offsets"):
+            return [{"token_ids": ids, "tokens_generated": len(ids)} for ids in token_lists]
+        
+        if texts is None:
+            # Decode only the generated part
+            texts = [text.strip() for text in self.tokenizer.batch_decode(token_lists, skip_special_tokens=True)]
+        
+        return [
+            {"result": text, "tokens_generated": len(ids)}
+            for text, ids in zip(texts, token_lists)
+        ]
+    
+    def _decode_with_offsets(self, ids: List[int]) -> Tuple[str, List[List[int]]]:
+        """
+        Decode ids and return [start, end) character spans for every token
+        
+        Decodes incrementally in one pass. Each step only decodes the window
+        since the last complete character, plus the token before it so that
+        word-boundary spaces come out right. A token that ends mid-character
+        gets an empty span and the one that completes it takes the whole
+        character. Spans refer to the stripped text, as in the default path.
+        """
+        def decode(window: List[int]) -> str:
+            return self.tokenizer.decode(window, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        
+        text = ""
+        raw_offsets = []
+        prefix_offset = read_offset = 0
+        
+        for i in range(len(ids)):
+            prefix_text = decode(ids[prefix_offset:read_offset])
+            new_text = decode(ids[prefix_offset:i + 1])
+            
+            if new_text.endswith("\ufffd"):
+                # Incomplete UTF-8 sequence; wait for the tokens that finish it
+                raw_offsets.append((len(text), len(text)))
+                continue
+            
+            delta = new_text[len(prefix_text):]
+            raw_offsets.append((len(text), len(text) + len(delta)))
+            text += delta
+            prefix_offset, read_offset = read_offset, i + 1
+        
+        stripped = text.strip()
+        lead = len(text) - len(text.lstrip())
+        offsets = [
+            [min(max(start - lead, 0), len(stripped)), min(max(end - lead, 0), len(stripped))]
+            for start, end in raw_offsets
+        ]
+        return stripped, offsets
+    
+    async def _generate_engine(self, input_ids: List[int], params: Dict[str, Any]) -> Dict[str, Any]:
+        """Submit one request straight to the serving engine, which batches in flight"""
+        do_sample = params["do_sample"]
+        detokenize = not (params.get("return_tokens") or params.get("return_offsets"))
+        sampling_params = self._sampling_params_cls(
+            max_tokens=min(params["max_new_tokens"], self.config.max_new_tokens),
+            temperature=params["temperature"] if do_sample else 0.0,
+            top_k=params["top_k"] if do_sample else 1,
+            top_p=params["top_p"],
+            repetition_penalty=1.1,
+            # Token ids and offsets are built from raw ids, so the engine's text is unused
+            detokenize=detokenize
+        )
+        prompt = {"prompt_token_ids": input_ids}
+        
+        if self.config.backend == "vllm":
+            output = None
+            async for output in self.engine.generate(prompt, sampling_params, uuid.uuid4().hex):
+                pass
+        else:
+            output = await self.engine.generate_async(prompt, sampling_params=sampling_params).aresult()
+        
+        completion = output.outputs[0]
+        return self._format_outputs(
+            [list(completion.token_ids)],
+            params,
+            [completion.text.strip()] if detokenize else None
+        )[0]
 
-# Flask API application
-app = Flask(__name__)
+# FastAPI application
+app = FastAPI(title="MedGemma Local Inference", default_response_class=ORJSONResponse)
 
 # Global model instance
 medgemma_model = None
 
+# Threads that block on streamers; bounded so SSE clients cannot drain the default executor
+stream_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('MEDGEMMA_STREAM_WORKERS', 8)),
+    thread_name_prefix="medgemma-stream"
+)
+# How long a stream read may hold a thread before checking for a client disconnect
+STREAM_POLL_TIMEOUT_S = 1.0
+
+# Models this service knows how to serve, listed by /models
+AVAILABLE_MODELS = [
+    {
+        "id": "RSM-VLM/med-gemma",
+        "name": "MedGemma 7B",
+        "description": "Medical Gemma model fine-tuned for clinical tasks"
+    },
+    {
+        "id": "google/gemma-7b-it",
+        "name": "Gemma 7B Instruct",
+        "description": "Base Gemma model suitable for medical fine-tuning"
+    }
+]
+
+def cache_status_responses():
+    """Pre-serialize the /health and /models bodies; they only change when the model does"""
+    model_id = medgemma_model.config.model_id if medgemma_model else None
+    
+    app.state.health_body = orjson.dumps({
+        "status": "healthy" if medgemma_model else "unhealthy",
+        "model_loaded": medgemma_model is not None,
+        "model_id": model_id
+    })
+    app.state.models_body = orjson.dumps({
+        "models": [{**model, "loaded": model["id"] == model_id} for model in AVAILABLE_MODELS],
+        "current_model": model_id
+    })
+
+cache_status_responses()
+
 def initialize_model():
     """Initialize MedGemma model on startup"""
     global medgemma_model
@@ -203,47 +1087,110 @@ def initialize_model():
     try:
         # Check for custom model ID from environment
         model_id = os.getenv('MEDGEMMA_MODEL_ID', 'RSM-VLM/med-gemma')
+        backend = os.getenv('MEDGEMMA_BACKEND', 'transformers')
+        vllm_quantization = os.getenv('MEDGEMMA_VLLM_QUANTIZATION', 'awq') or None
         use_quantization = os.getenv('USE_QUANTIZATION', 'true').lower() == 'true'
+        max_batch_size = int(os.getenv('MEDGEMMA_MAX_BATCH_SIZE', 8))
+        batch_timeout_ms = float(os.getenv('MEDGEMMA_BATCH_TIMEOUT_MS', 10))
+        max_new_tokens = int(os.getenv('MEDGEMMA_MAX_NEW_TOKENS', 512))
+        use_static_cache = os.getenv('USE_STATIC_CACHE', 'true').lower() == 'true'
+        kv_cache_max_mb = int(os.getenv('MEDGEMMA_KV_CACHE_MAX_MB', 0)) or None
+        use_torch_compile = os.getenv('USE_TORCH_COMPILE', 'true').lower() == 'true'
+        use_prefix_cache = os.getenv('USE_PREFIX_CACHE', 'true').lower() == 'true'
+        attn_implementation = os.getenv('MEDGEMMA_ATTN_IMPLEMENTATION') or None
+        warmup = os.getenv('MEDGEMMA_WARMUP', 'true').lower() == 'true'
         
         config = MedGemmaConfig(
             model_id=model_id,
-            use_quantization=use_quantization
+            backend=backend,
+            vllm_quantization=vllm_quantization,
+            use_quantization=use_quantization,
+            max_batch_size=max_batch_size,
+            batch_timeout_ms=batch_timeout_ms,
+            max_new_tokens=max_new_tokens,
+            use_static_cache=use_static_cache,
+            kv_cache_max_mb=kv_cache_max_mb,
+            use_torch_compile=use_torch_compile,
+            use_prefix_cache=use_prefix_cache,
+            attn_implementation=attn_implementation
         )
         
-        medgemma_model = MedGemmaInference(config)
+        model = MedGemmaInference(config)
+        
+        if warmup:
+            model.warmup()
+        
+        medgemma_model = model
         logger.info("MedGemma model initialized successfully")
         
     except Exception as e:
         logger.error(f"Failed to initialize MedGemma: {e}")
         medgemma_model = None
+    
+    cache_status_responses()
+
+def format_sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Serialize one server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
 
-@app.route('/health', methods=['GET'])
-def health_check():
+async def stream_analysis(request: Request, prompt: MedicalPrompt, generation_kwargs: Dict[str, Any]):
+    """Yield generated text as SSE chunks, then a trailing `done` event with metadata"""
+    streamer = medgemma_model.create_streamer(timeout=STREAM_POLL_TIMEOUT_S)
+    cancel = CancelGeneration()
+    generation = asyncio.ensure_future(
+        medgemma_model.generate_response(prompt=prompt, streamer=streamer, cancel=cancel, **generation_kwargs)
+    )
+    loop = asyncio.get_running_loop()
+    
+    try:
+        # The streamer is a blocking iterator fed from the GPU thread
+        while True:
+            try:
+                chunk = await loop.run_in_executor(stream_executor, next, streamer, None)
+            except queue.Empty:
+                # Queued behind other streams or still prefilling; give the thread back meanwhile
+                if await request.is_disconnected():
+                    logger.info("Stream client disconnected")
+                    return
+                continue
+            if chunk is None:
+                break
+            if chunk:
+                yield format_sse({"token": chunk})
+        
+        response = await generation
+        response.pop("result", None)
+        yield format_sse(response, event="done")
+    finally:
+        if not generation.done():
+            # Free the GPU thread: stop a running generate() and drop a queued request
+            cancel.set()
+            generation.cancel()
+
+@app.get('/health')
+async def health_check():
     """Health check endpoint"""
-    return jsonify({
-        "status": "healthy" if medgemma_model else "unhealthy",
-        "model_loaded": medgemma_model is not None,
-        "model_id": medgemma_model.config.model_id if medgemma_model else None
-    })
+    return Response(app.state.health_body, media_type="application/json")
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
+@app.post('/analyze')
+async def analyze(request: Request):
     """Main analysis endpoint"""
     if not medgemma_model:
-        return jsonify({
+        return ORJSONResponse({
             "success": False,
             "error": "MedGemma model not available"
-        }), 503
+        }, status_code=503)
     
     try:
-        data = request.get_json()
+        data = orjson.loads(await request.body())
         
         # Validate required fields
         if not data or 'input' not in data:
-            return jsonify({
+            return ORJSONResponse({
                 "success": False,
                 "error": "Missing required field: input"
-            }), 400
+            }, status_code=400)
         
         # Extract parameters
         text = data['input']
@@ -251,61 +1198,48 @@ def analyze():
         context = data.get('context', '')
         options = data.get('options', {})
         
-        # Add context to input if provided
-        if context:
-            text = f"{context}\n\n{text}"
+        # Templating and tokenization happen on the tokenizer pool
+        prompt = MedicalPrompt(text=text, task_type=task_type, context=context)
         
-        # Format prompt for medical analysis
-        prompt = medgemma_model.format_medical_prompt(text, task_type)
+        generation_kwargs = {
+            "max_new_tokens": options.get('maxTokens', 512),
+            "temperature": options.get('temperature', 0.7),
+            "top_k": options.get('top_k', 50),
+            "top_p": options.get('top_p', 0.95),
+            "return_tokens": bool(options.get('return_tokens', False)),
+            "return_offsets": bool(options.get('return_offsets', False))
+        }
+        
+        if options.get('stream') and medgemma_model.supports_streaming:
+            return StreamingResponse(
+                stream_analysis(request, prompt, generation_kwargs),
+                media_type="text/event-stream"
+            )
         
         # Generate response
-        response = medgemma_model.generate_response(
-            prompt=prompt,
-            max_new_tokens=options.get('maxTokens', 512),
-            temperature=options.get('temperature', 0.7),
-            top_k=options.get('top_k', 50),
-            top_p=options.get('top_p', 0.95)
-        )
+        response = await medgemma_model.generate_response(prompt=prompt, **generation_kwargs)
         
-        return jsonify(response)
+        return response
         
     except Exception as e:
         logger.error(f"Analysis failed: {e}")
-        return jsonify({
+        return ORJSONResponse({
             "success": False,
             "error": str(e)
-        }), 500
+        }, status_code=500)
 
-@app.route('/models', methods=['GET'])
-def list_models():
+@app.get('/models')
+async def list_models():
     """List available models"""
-    models = [
-        {
-            "id": "RSM-VLM/med-gemma",
-            "name": "MedGemma 7B",
-            "description": "Medical Gemma model fine-tuned for clinical tasks",
-            "loaded": medgemma_model and medgemma_model.config.model_id == "RSM-VLM/med-gemma"
-        },
-        {
-            "id": "google/gemma-7b-it",
-            "name": "Gemma 7B Instruct",
-            "description": "Base Gemma model suitable for medical fine-tuning",
-            "loaded": False
-        }
-    ]
-    
-    return jsonify({
-        "models": models,
-        "current_model": medgemma_model.config.model_id if medgemma_model else None
-    })
+    return Response(app.state.models_body, media_type="application/json")
 
 if __name__ == '__main__':
     # Initialize model on startup
     initialize_model()
     
-    # Start Flask server
+    # Start ASGI server; a single worker owns the GPU and its request queue
     port = int(os.getenv('PORT', 8000))
     debug = os.getenv('DEBUG', 'false').lower() == 'true'
     
     logger.info(f"Starting MedGemma service on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
+    uvicorn.run(app, host='0.0.0.0', port=port, workers=1, loop="uvloop", log_level="debug" if debug else "info")
\ No newline at end of file
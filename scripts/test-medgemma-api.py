@@ -8,77 +8,78 @@ import os
 import sys
 import json
 import time
-import requests
-from typing import Dict, Any, List
+import asyncio
+import httpx
+from typing import Dict, Any, List, Optional
 
-def test_hf_api_access():
-    """Test basic Hugging Face API access"""
+def get_api_key() -> str:
+    return os.getenv('HUGGING_FACE_API_KEY', 'your_hugging_face_api_key_here')
+
+def build_headers(api_key: str) -> Dict[str, str]:
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+
+async def test_hf_api_access(client: httpx.AsyncClient) -> Optional[Dict[str, Any]]:
+    """Test basic Hugging Face API access, returning the whoami info on success"""
     print("🔑 Testing Hugging Face API Access")
     print("=" * 40)
     
-    api_key = os.getenv('HUGGING_FACE_API_KEY', 'your_hugging_face_api_key_here')
+    api_key = get_api_key()
     
     if not api_key:
         print("❌ HUGGING_FACE_API_KEY not found in environment")
-        return False
+        return None
     
     print(f"✅ API Key: {api_key[:10]}...")
     
-    # Test with a simple model first
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    
     # Test basic API connectivity
     try:
-        response = requests.get(
-            'https://huggingface.co/api/whoami',
-            headers=headers,
-            timeout=10
-        )
+        response = await client.get('https://huggingface.co/api/whoami', timeout=10)
         
         if response.status_code == 200:
             user_info = response.json()
             print(f"✅ Authenticated as: {user_info.get('name', 'Unknown')}")
-            return True
+            return user_info
         else:
             print(f"❌ Authentication failed: {response.status_code}")
-            return False
+            return None
             
     except Exception as e:
         print(f"❌ API connection failed: {e}")
-        return False
+        return None
 
-def test_model_access(model_name: str) -> Dict[str, Any]:
+async def test_model_access_async(client: httpx.AsyncClient, model_name: str) -> Dict[str, Any]:
     """Test access to a specific model"""
-    print(f"🧪 Testing model: {model_name}")
-    
-    api_key = os.getenv('HUGGING_FACE_API_KEY', 'your_hugging_face_api_key_here')
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
+    # Checks run concurrently, so buffer output and print it as one block per model
+    lines = [f"🧪 Testing model: {model_name}"]
     
+    try:
+        return await _check_model(client, model_name, lines.append)
+    finally:
+        print("\n".join(lines))
+        print()  # Add spacing between tests
+
+async def _check_model(client: httpx.AsyncClient, model_name: str, log) -> Dict[str, Any]:
     # First check model info
     try:
-        info_response = requests.get(
+        info_response = await client.get(
             f'https://huggingface.co/api/models/{model_name}',
-            headers=headers,
             timeout=10
         )
         
         if info_response.status_code == 200:
             model_info = info_response.json()
-            print(f"  ✅ Model info accessible")
-            print(f"     Downloads: {model_info.get('downloads', 'N/A')}")
-            print(f"     Gated: {model_info.get('gated', 'Unknown')}")
+            log(f"  ✅ Model info accessible")
+            log(f"     Downloads: {model_info.get('downloads', 'N/A')}")
+            log(f"     Gated: {model_info.get('gated', 'Unknown')}")
         else:
-            print(f"  ❌ Model info not accessible: {info_response.status_code}")
+            log(f"  ❌ Model info not accessible: {info_response.status_code}")
             return {"accessible": False, "reason": f"Info API returned {info_response.status_code}"}
             
     except Exception as e:
-        print(f"  ❌ Model info error: {e}")
+        log(f"  ❌ Model info error: {e}")
         return {"accessible": False, "reason": str(e)}
     
     # Test inference API
@@ -99,25 +100,24 @@ def test_model_access(model_name: str) -> Dict[str, Any]:
     }
     
     try:
-        print(f"  📤 Testing inference...")
+        log(f"  📤 Testing inference...")
         
-        response = requests.post(
+        response = await client.post(
             f'https://api-inference.huggingface.co/models/{model_name}',
-            headers=headers,
             json=payload,
             timeout=60
         )
         
-        print(f"  📥 Response status: {response.status_code}")
+        log(f"  📥 Response status: {response.status_code}")
         
         if response.status_code == 200:
             result = response.json()
-            print(f"  ✅ Inference successful!")
+            log(f"  ✅ Inference successful!")
             
             # Extract response text
             if isinstance(result, list) and len(result) > 0:
                 generated_text = result[0].get('generated_text', 'No text generated')
-                print(f"  🩺 Generated: {generated_text[:100]}...")
+                log(f"  🩺 Generated: {generated_text[:100]}...")
                 
             return {
                 "accessible": True,
@@ -126,27 +126,27 @@ def test_model_access(model_name: str) -> Dict[str, Any]:
             }
             
         elif response.status_code == 401:
-            print(f"  ❌ Unauthorized - model may require license acceptance")
+            log(f"  ❌ Unauthorized - model may require license acceptance")
             return {"accessible": False, "reason": "Unauthorized - license required"}
             
         elif response.status_code == 403:
-            print(f"  ❌ Forbidden - insufficient permissions")  
+            log(f"  ❌ Forbidden - insufficient permissions")  
             return {"accessible": False, "reason": "Forbidden"}
             
         elif response.status_code == 503:
-            print(f"  ⏳ Model is loading (503) - this is normal")
+            log(f"  ⏳ Model is loading (503) - this is normal")
             return {"accessible": True, "inference_working": False, "reason": "Model loading"}
             
         else:
-            print(f"  ❌ Inference failed: {response.status_code}")
-            print(f"     Response: {response.text[:200]}")
+            log(f"  ❌ Inference failed: {response.status_code}")
+            log(f"     Response: {response.text[:200]}")
             return {"accessible": False, "reason": f"HTTP {response.status_code}"}
             
     except Exception as e:
-        print(f"  ❌ Inference error: {e}")
+        log(f"  ❌ Inference error: {e}")
         return {"accessible": False, "reason": str(e)}
 
-def test_medical_scenarios():
+async def test_medical_scenarios(client: httpx.AsyncClient, results: Dict[str, Dict[str, Any]]):
     """Test with specific medical scenarios"""
     print("\\n🏥 Testing Medical AI Scenarios")
     print("=" * 40)
@@ -178,9 +178,15 @@ def test_medical_scenarios():
         'google/medgemma-4b-it'
     ]
     
+    # Reuse results from the main run and only check models it did not cover
+    unchecked = [model for model in test_models if model not in results]
+    if unchecked:
+        print(f"\\n🔍 Checking {', '.join(unchecked)} for medical testing...")
+        checked = await asyncio.gather(*[test_model_access_async(client, m) for m in unchecked])
+        results = {**results, **dict(zip(unchecked, checked))}
+    
     for model in test_models:
-        print(f"\\n🔍 Checking {model} for medical testing...")
-        result = test_model_access(model)
+        result = results[model]
         if result.get('accessible') and result.get('inference_working'):
             working_model = model
             print(f"✅ Will use {model} for medical scenarios")
@@ -202,13 +208,17 @@ def test_medical_scenarios():
         # Would test with the working model here
         print("💡 Scenario defined - ready for testing with available model")
 
-def main():
+async def main():
     """Main test function"""
     print("🏥 MedGemma Hugging Face API Test Suite")
     print("=" * 50)
     
+    async with httpx.AsyncClient(headers=build_headers(get_api_key())) as client:
+        await run_tests(client)
+
+async def run_tests(client: httpx.AsyncClient):
     # Test API access first
-    if not test_hf_api_access():
+    if not await test_hf_api_access(client):
         print("\\n❌ Basic API access failed - cannot proceed")
         return
     
@@ -224,17 +234,12 @@ def main():
         'google/gemma-7b-it'   # Fallback
     ]
     
-    results = {}
-    working_models = []
-    
-    for model in models_to_test:
-        result = test_model_access(model)
-        results[model] = result
-        
-        if result.get('accessible'):
-            working_models.append(model)
-        
-        print()  # Add spacing between tests
+    # Network-bound checks, so run them all concurrently
+    results = dict(zip(
+        models_to_test,
+        await asyncio.gather(*[test_model_access_async(client, m) for m in models_to_test])
+    ))
+    working_models = [model for model in models_to_test if results[model].get('accessible')]
     
     # Summary
     print("\\n📊 Test Summary")
@@ -264,7 +269,7 @@ def main():
     
     # Test medical scenarios if we have working models
     if working_models:
-        test_medical_scenarios()
+        await test_medical_scenarios(client, results)
 
 if __name__ == "__main__":
     # Load environment variables
@@ -275,4 +280,4 @@ if __name__ == "__main__":
                     key, value = line.strip().split('=', 1)
                     os.environ[key] = value
     
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
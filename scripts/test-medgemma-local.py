@@ -3,6 +3,7 @@
 Test local MedGemma inference using transformers library
 """
 
+import gc
 import os
 import sys
 import time
@@ -17,7 +18,7 @@ def test_medgemma_local():
     try:
         # Import required libraries
         print("📦 Importing transformers...")
-        from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+        from transformers import pipeline
         import torch
         
         print(f"✅ PyTorch version: {torch.__version__}")
@@ -36,69 +37,72 @@ def test_medgemma_local():
         "google/medgemma-27b-text-it"
     ]
     
+    # Test medical questions
+    medical_questions = [
+        "What are the common symptoms of pneumonia?",
+        "Explain the difference between Type 1 and Type 2 diabetes.",
+        "What imaging modalities are used to diagnose stroke?"
+    ]
+    
     for model_name in models_to_test:
         print(f"\n🔬 Testing model: {model_name}")
         print("-" * 40)
         
+        pipe = None
+        
         try:
             start_time = time.time()
             
-            # Load tokenizer
-            print("📥 Loading tokenizer...")
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
-            
-            # Test medical questions
-            medical_questions = [
-                "What are the common symptoms of pneumonia?",
-                "Explain the difference between Type 1 and Type 2 diabetes.",
-                "What imaging modalities are used to diagnose stroke?"
-            ]
-            
             print("🩺 Testing with pipeline approach...")
             
-            # Use pipeline for easier inference
+            # Use pipeline for easier inference; it loads the model and tokenizer once
             pipe = pipeline(
                 "text-generation", 
                 model=model_name,
                 device=0 if torch.cuda.is_available() else -1,
                 torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                model_kwargs={"load_in_4bit": True} if torch.cuda.is_available() else {}
+                model_kwargs={"load_in_4bit": True} if torch.cuda.is_available() else {},
+                batch_size=len(medical_questions)
             )
             
-            for i, question in enumerate(medical_questions, 1):
+            # Batched generation needs a pad token and left padding
+            if pipe.tokenizer.pad_token is None:
+                pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+            pipe.tokenizer.padding_side = "left"
+            
+            # Format each question as its own chat conversation
+            conversations = [[{"role": "user", "content": question}] for question in medical_questions]
+            
+            try:
+                # Generate all responses in a single batched call
+                batch_outputs = pipe(
+                    conversations,
+                    max_new_tokens=150,
+                    temperature=0.7,
+                    do_sample=True,
+                    top_k=50,
+                    top_p=0.95,
+                    repetition_penalty=1.1,
+                    pad_token_id=pipe.tokenizer.pad_token_id
+                )
+            except Exception as gen_error:
+                print(f"❌ Generation error: {gen_error}")
+                batch_outputs = []
+            
+            for i, (question, outputs) in enumerate(zip(medical_questions, batch_outputs), 1):
                 print(f"\n📝 Question {i}: {question}")
                 
-                # Format as chat message
-                messages = [{"role": "user", "content": question}]
-                
-                try:
-                    # Generate response
-                    outputs = pipe(
-                        messages,
-                        max_new_tokens=150,
-                        temperature=0.7,
-                        do_sample=True,
-                        top_k=50,
-                        top_p=0.95,
-                        repetition_penalty=1.1,
-                        pad_token_id=tokenizer.eos_token_id
-                    )
-                    
-                    # Extract generated text
-                    if outputs and len(outputs) > 0:
-                        response = outputs[0].get('generated_text', 'No response generated')
-                        if isinstance(response, list) and len(response) > 1:
-                            # Get the assistant's response (last message)
-                            assistant_response = response[-1].get('content', 'No content found')
-                            print(f"🤖 Response: {assistant_response}")
-                        else:
-                            print(f"🤖 Response: {str(response)[:300]}...")
+                # Extract generated text
+                if outputs and len(outputs) > 0:
+                    response = outputs[0].get('generated_text', 'No response generated')
+                    if isinstance(response, list) and len(response) > 1:
+                        # Get the assistant's response (last message)
+                        assistant_response = response[-1].get('content', 'No content found')
+                        print(f"🤖 Response: {assistant_response}")
                     else:
-                        print("❌ No response generated")
-                        
-                except Exception as gen_error:
-                    print(f"❌ Generation error: {gen_error}")
-                    continue
+                        print(f"🤖 Response: {str(response)[:300]}...")
+                else:
+                    print("❌ No response generated")
             
             load_time = time.time() - start_time
             print(f"\n⏱️  Total time: {load_time:.2f} seconds")
@@ -116,6 +120,14 @@ def test_medgemma_local():
                 continue
             else:
                 return False
+        
+        finally:
+            # Release this model's weights before the next one is loaded
+            if pipe is not None:
+                del pipe
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
     
     return False
 